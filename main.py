@@ -19,105 +19,747 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE. """
 
+import asyncio
 import base64
-import glob
+import fnmatch
+import hashlib
+import heapq
 import io
 import os
-from collections.abc import Iterable
-from itertools import repeat
-from multiprocessing import Pool
+import queue
+import subprocess
+import tempfile
+import threading
+from collections.abc import Iterable, Iterator
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from itertools import islice
+from multiprocessing import Pool, resource_tracker, shared_memory
 from pathlib import Path
-from typing import Optional, Union, Tuple
+from typing import Callable, Optional, Union, Tuple
 
+# One tesseract thread per OCR worker; we parallelize across processes
+# instead. Must be set before the tesseract library is loaded.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+# Smaller Pillow block pool allocations actually get returned to the OS once
+# a page's image is closed, instead of lingering in the pool for the whole
+# run. Must be set before PIL is imported.
+os.environ.setdefault("PILLOW_BLOCK_SIZE", "1m")
+
+import aiohttp
 import click
+import diskcache
 import fitz
-import pytesseract
-import requests
 from PIL import Image
 from tqdm import tqdm
 
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
 StrPath = Union[str, os.PathLike]
 
+# noinspection HttpUrlsUsage
+UPLOAD_URL = "http://service.docleaner.cn/attachCollect/upload"
+# noinspection HttpUrlsUsage
+EXE_URL = "http://service.docleaner.cn/exe/daqw"
+
+#: Maximum number of in-flight requests to the docleaner service. The server
+#: saturates way before we do, so there is little point in raising this.
+CLEAN_CONCURRENCY = 32
+
+#: The cleaning operations requested from docleaner. Part of the cache key:
+#: changing them invalidates previously cached responses.
+CLEAN_PARAMS = "降噪,去斑点,去黑边,去背景,自动纠斜"
+
+#: Upload batching limits: a batch is closed once it reaches this many pages
+#: or this many payload bytes, whichever comes first. Past a few MB per
+#: request batching gains nothing and only delays the first result.
+UPLOAD_BATCH_PAGES = 16
+UPLOAD_BATCH_BYTES = 3 * 2 ** 20
+
+#: Whether the server accepts several files in one multipart upload. Flipped
+#: off for the rest of the run the first time a batched response does not
+#: parse, after which we transparently fall back to one upload per page.
+_batch_upload = True
+
+#: Where cleaned pages and OCR results are memoized, keyed by content hash.
+#: Identical pages (blank ones, or an unchanged page on a re-run) never hit
+#: the network or tesseract twice.
+CACHE_DIR = os.path.join("~", ".cache", "docleaner")
+
+#: Process-local cache handle; each pool worker opens its own on first use.
+_cache = None
+
+
+def _get_cache() -> diskcache.Cache:
+    global _cache
+    if _cache is None:
+        _cache = diskcache.Cache(os.path.expanduser(CACHE_DIR))
+    return _cache
+
+
+#: An image page as the already-compressed stream (png/jpeg/...) plus its
+#: pixel dimensions, so it can be inserted into a PDF without a decode +
+#: re-encode round trip through PIL.
+ImagePage = Tuple[bytes, int, int]
+
 
-def merge_to_pdf(pages: Iterable[Union[Image.Image, bytes]], output: StrPath):
+#: How many pages to accumulate in memory before flushing them to the output
+#: file. Keeps peak memory at O(FLUSH_EVERY) pages instead of O(document).
+FLUSH_EVERY = 8
+
+#: A PDF page bearing more than this many characters of text is considered
+#: born-digital: it is copied to the output as-is rather than rasterized,
+#: cleaned and OCR-ed (all of which could only lose fidelity).
+TEXT_PAGE_THRESHOLD = 40
+
+
+def merge_to_pdf(pages: Iterable[Union[ImagePage, Image.Image, bytes]],
+                 output: StrPath):
     """
     Converts and merges images to a one-page pdf file, performing optional
-    OCR in the process.
+    OCR in the process. Pages are appended to a partial file in small
+    batches via incremental saves, so memory no longer grows with the
+    document length; the finished document is then rewritten once with
+    garbage collection and stream compression, which dedupes objects and
+    undoes the size overhead incremental saving accumulates.
 
-    :param pages: A generator yielding PIL image objects.
+    :param pages: A generator yielding :data:`ImagePage` tuples, PIL image
+        objects, or single-page PDFs in raw bytes.
     :param output: Path to the result pdf.
     """
-    doc = fitz.Document()
+    output = os.fspath(output)
+    partial = output + ".partial"
+    chunk = fitz.Document()
+    out_doc = None
+
+    def flush():
+        nonlocal chunk, out_doc
+        if chunk.page_count == 0:
+            return
+        if out_doc is None:
+            # A PDF with zero pages cannot be saved, so the partial file
+            # only comes into existence with the first flush.
+            chunk.save(partial)
+            out_doc = fitz.Document(partial)
+        else:
+            out_doc.insert_pdf(chunk)
+            out_doc.saveIncr()
+        chunk.close()
+        chunk = fitz.Document()
+
     for page in pages:
-        if isinstance(page, Image.Image):
+        if isinstance(page, tuple):
+            data, width, height = page
+            doc_page = chunk.new_page(width=width, height=height)
+            doc_page.insert_image(fitz.Rect(0, 0, width, height), stream=data)
+        elif isinstance(page, Image.Image):
             # noinspection PyUnresolvedReferences
-            doc_page = doc.new_page(width=page.width, height=page.height)
-            buffer = io.BytesIO()
-            page.save(buffer, format="jpeg")
-            doc_page.insert_image(fitz.Rect(0, 0, page.width, page.height),
-                              stream=buffer)
+            doc_page = chunk.new_page(width=page.width, height=page.height)
+            rect = fitz.Rect(0, 0, page.width, page.height)
+            if page.mode not in ("RGB", "L"):
+                converted = page.convert("RGB")
+                page.close()
+                page = converted
+            # Hand the raw pixels to fitz as a pixmap instead of routing
+            # them through the JPEG encoder (and a second lossy pass).
+            colorspace = fitz.csGRAY if page.mode == "L" else fitz.csRGB
+            pix = fitz.Pixmap(colorspace, page.width, page.height,
+                              page.tobytes(), False)
+            doc_page.insert_image(rect, pixmap=pix)
+            # Release the pixel storage right away instead of waiting for the
+            # garbage collector; on long documents this adds up.
+            page.close()
         else:
             page = fitz.Document(stream=page, filetype="pdf")
-            doc.insert_pdf(page)
-    doc.save(output)
+            chunk.insert_pdf(page)
+        if chunk.page_count >= FLUSH_EVERY:
+            flush()
+    flush()
+    if out_doc is not None:
+        out_doc.close()
+        final = fitz.Document(partial)
+        final.save(output, garbage=4, deflate=True, deflate_images=True,
+                   deflate_fonts=True, use_objstms=1)
+        final.close()
+        os.remove(partial)
+
 
+#: Worker-local cache of parsed fitz documents, so rasterizing N pages of the
+#: same PDF parses it once per worker instead of N times.
+_docs = {}
 
-def convert_pdf_page_to_image(pdf: StrPath, idx: int, dpi: int) -> bytes:
+
+def _open_document(pdf: StrPath) -> fitz.Document:
+    doc = _docs.get(pdf)
+    if doc is None:
+        doc = _docs[pdf] = fitz.Document(pdf)
+    return doc
+
+
+def convert_pdf_page_to_image(pdf: StrPath, idx: int, dpi: int,
+                              gray: bool = True) -> bytes:
     """
     Converts a PDF page to an image.
 
     :param pdf: Path to the PDF.
     :param idx: Page index (0-offset).
     :param dpi: Pixel density. A value > 200 is recommended.
+    :param gray: Whether to render in grayscale. Tesseract converts its
+        input to grayscale anyway, and a single-channel page is a third the
+        bytes through every later stage (upload, decode, OCR).
     :return: Raw image as bytes.
     """
-    doc = fitz.Document(pdf)
+    doc = _open_document(pdf)
     matrix = fitz.Matrix(dpi / 72, dpi / 72)
     assert 0 <= idx < doc.page_count
+    colorspace = fitz.csGRAY if gray else fitz.csRGB
     # noinspection PyUnresolvedReferences
-    return doc[idx].get_pixmap(matrix=matrix).tobytes()
+    return doc[idx].get_pixmap(matrix=matrix, colorspace=colorspace,
+                               alpha=False).tobytes()
 
 
-def clean_single_page(args: Tuple[StrPath, int, int, bool, bool]) \
-        -> Union[Image.Image, bytes]:
+#: One-slot prefetch state per rasterizer worker: while the current page's
+#: result is being shipped out of the worker, the next page is already
+#: rendering on a helper thread. Chunked dispatch hands each worker
+#: consecutive page indices, so the prefetch almost always hits.
+_prefetch_pool = None
+_prefetch_slot = None
+
+
+def _drain_prefetch():
+    """
+    Waits out any in-flight prefetch render, returning ``(key, image)`` on
+    success or None. fitz documents are not thread-safe, so every code path
+    touching the cached document on the worker thread must drain first; at
+    most one render runs at a time. A failed prefetch is discarded — the
+    direct render of that page will reproduce the error where it belongs.
     """
-    Cleans a single page.
+    global _prefetch_slot
+    if _prefetch_slot is None:
+        return None
+    key, future = _prefetch_slot
+    _prefetch_slot = None
+    try:
+        return key, future.result()
+    except Exception:  # noqa
+        return None
+
+
+def _rasterize_prefetched(page: StrPath, idx: int, dpi: int, gray: bool,
+                          prefetch_next: bool) -> bytes:
+    global _prefetch_pool, _prefetch_slot
+    if _prefetch_pool is None:
+        _prefetch_pool = ThreadPoolExecutor(max_workers=1)
+    key = (page, idx, dpi, gray)
+    drained = _drain_prefetch()
+    if drained is not None and drained[0] == key:
+        image = drained[1]
+    else:
+        image = convert_pdf_page_to_image(page, idx, dpi, gray)
+    if prefetch_next and idx + 1 < _open_document(page).page_count:
+        _prefetch_slot = ((page, idx + 1, dpi, gray),
+                          _prefetch_pool.submit(convert_pdf_page_to_image,
+                                                page, idx + 1, dpi, gray))
+    return image
+
+
+PageArgs = Tuple[StrPath, int, int, bool, bool, bool, bool, bool]
+
+
+def _load_page(args: PageArgs) -> Tuple[int, str, int, str, bool, bool]:
+    """
+    Rasterization stage: turns one page argument tuple into raw image bytes.
+    Runs in the rasterizer pool. The image bytes are placed in a shared
+    memory segment rather than pickled through the pool's result pipe, which
+    would copy them in 64 kB chunks; only the segment name crosses the
+    process boundary.
 
     :param args: A tuple consisting of (in order):
         1. Path to the page (pdf or image),
         2. Index (image index or page index in PDF),
         3. DPI (-1 if an image is direcly supplied),
         4. Whether to perform OCR,
-        5. Whether to actually clean the page.
-    :return:  If OCR is enabled, a OCR-ed PDF in raw bytes, otherwise an PIL
-        Image object representing the cleaned page.
+        5. Whether to actually clean the page,
+        6. Whether to rasterize in grayscale,
+        7. Whether to skip processing and copy the original page (it
+           already carries a text layer),
+        8. Whether the next page index is worth prefetching (i.e. it exists
+           and is not itself a pass-through page).
+    :return: The index, the shared memory segment name holding the image,
+        its size, the image extension and the ocr / clean flags, for
+        consumption by the cleaning stage (which unlinks the segment).
     """
-    page, idx, dpi, ocr, clean = args
-    if dpi > 0:
-        image = convert_pdf_page_to_image(page, idx, dpi)
+    page, idx, dpi, ocr, clean, gray, skip, prefetch_next = args
+    if skip:
+        # The cached document must be quiescent before the copy runs.
+        _drain_prefetch()
+        # convert_to_pdf(i, i) rejects i > 0 on current PyMuPDF; copying the
+        # page into a fresh document works on every version.
+        single = fitz.Document()
+        single.insert_pdf(_open_document(page), from_page=idx, to_page=idx)
+        image = single.tobytes()
+        single.close()
+        ext = ".pdf"
+        ocr = clean = False
+    elif dpi > 0:
+        image = _rasterize_prefetched(page, idx, dpi, gray, prefetch_next)
         ext = ".png"
     else:
         with open(page, "rb") as file:
             image = file.read()
         ext = os.path.splitext(page)[1]
-    if clean:
-        # noinspection HttpUrlsUsage
-        req = requests.post("http://service.docleaner.cn/attachCollect/upload",
-                            files={"file": (f"image{ext}", image)})
-        data = {
-            # Weird typo in the API.
-            "paramers": "降噪,去斑点,去黑边,去背景,自动纠斜",
-            "type": "image",
-            "storePath": req.json()["data"]["storePath"],
-            "userId": ""
-        }
-        # noinspection HttpUrlsUsage
-        req = requests.post("http://service.docleaner.cn/exe/daqw", data=data)
-        image = base64.b64decode(req.json()["data"]["outFileStr"])
-    image = Image.open(io.BytesIO(image))
-    if ocr:
-        return pytesseract.image_to_pdf_or_hocr(image)
-    return image
+    shm = shared_memory.SharedMemory(create=True, size=len(image))
+    shm.buf[:len(image)] = image
+    shm.close()
+    # The consumer unlinks the segment; drop it from this worker's resource
+    # tracker, which would otherwise report it as leaked (and unlink it a
+    # second time) at worker shutdown. The parent's unlink() talks to a
+    # different tracker process, so it cannot do the unregistering for us.
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return idx, shm.name, len(image), ext, ocr, clean
+
+
+#: Thread-local tesserocr API instances. tesserocr releases the GIL during
+#: recognition, so OCR threads genuinely run in parallel, and each thread
+#: loads the language model exactly once instead of on every page.
+_tls = threading.local()
+
+
+def _get_api():
+    if tesserocr is None:
+        return None
+    api = getattr(_tls, "api", None)
+    if api is None:
+        api = _tls.api = tesserocr.PyTessBaseAPI(lang="eng")
+        api.SetVariable("tessedit_create_pdf", "1")
+    return api
+
+
+def _recognize(image: bytes) -> bytes:
+    api = _get_api()
+    if api is None:
+        # tesseract exits after a single image, so a truly persistent CLI
+        # worker is not possible; piping through stdin/stdout at least
+        # avoids a temp-file write + read-back per page.
+        result = subprocess.run(
+            ["tesseract", "stdin", "stdout", "-l", "eng", "pdf"],
+            input=image, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            check=True)
+        return result.stdout
+    with tempfile.TemporaryDirectory() as tmp:
+        base = os.path.join(tmp, "page")
+        if hasattr(os, "memfd_create"):
+            # Give tesseract the compressed stream directly through an
+            # in-memory fd: no PIL decode, no pixel buffer copy into
+            # SetImage. Opening /proc/self/fd/N rewinds to offset 0.
+            fd = os.memfd_create("docleaner-page")
+            try:
+                os.write(fd, image)
+                api.ProcessPages(base, f"/proc/self/fd/{fd}")
+            finally:
+                os.close(fd)
+        else:
+            with Image.open(io.BytesIO(image)) as pil_image:
+                api.ProcessPage(base, pil_image, 0, "page")
+        with open(base + ".pdf", "rb") as file:
+            return file.read()
+
+
+def _mean_word_confidence(image: bytes) -> float:
+    """Mean tesseract word confidence (0-100) for an image, 0 if no words."""
+    api = _get_api()
+    if api is not None:
+        with Image.open(io.BytesIO(image)) as pil_image:
+            api.SetImage(pil_image)
+            confidences = api.AllWordConfidences()
+        api.Clear()
+    else:
+        result = subprocess.run(
+            ["tesseract", "stdin", "stdout", "-l", "eng", "tsv"],
+            input=image, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            check=True)
+        confidences = []
+        for line in result.stdout.decode(errors="replace").splitlines()[1:]:
+            fields = line.split("\t")
+            # Word-level rows carry non-empty text and a real confidence.
+            if len(fields) >= 12 and fields[11].strip():
+                confidences.append(float(fields[10]))
+    if not confidences:
+        return 0.0
+    return sum(confidences) / len(confidences)
+
+
+def choose_dpi(pdf: StrPath, idx: int, gray: bool) -> int:
+    """
+    Picks a rasterization DPI by OCR-probing one page at 150 DPI. Tesseract
+    accuracy saturates well below 300 DPI on clean text, and every
+    downstream cost (rasterize, upload, OCR) scales with pixel count, so
+    the lowest DPI that already recognizes confidently wins.
+
+    :param pdf: Path to the PDF.
+    :param idx: Index of the probe page (0-offset).
+    :param gray: Whether rasterization is in grayscale.
+    :return: The chosen DPI.
+    """
+    probe = convert_pdf_page_to_image(pdf, idx, 150, gray)
+    confidence = _mean_word_confidence(probe)
+    if confidence >= 85:
+        return 150
+    if confidence >= 70:
+        return 200
+    return 300
+
+
+def _ocr_page(image: bytes) -> bytes:
+    """
+    OCR stage: recognizes one image into a single-page PDF. Runs on the OCR
+    thread pool, reusing the thread's tesserocr instance; falls back to
+    piping through the tesseract CLI when tesserocr is not installed.
+    Results are memoized on disk by content hash.
+
+    :param image: Raw image bytes.
+    :return: The OCR-ed single-page PDF in raw bytes.
+    """
+    engine = "tesseract-cli" if tesserocr is None else "tesserocr"
+    key = f"ocr:{hashlib.sha256(image).hexdigest()}:{engine}:eng"
+    cache = _get_cache()
+    result = cache.get(key)
+    if result is None:
+        result = _recognize(image)
+        cache.set(key, result)
+    return result
+
+
+def _parse_store_paths(payload, count: int) -> Optional[list]:
+    """
+    Extracts ``count`` storePaths from a batched upload response, or None if
+    the response does not look like one.
+    """
+    if isinstance(payload, list) and len(payload) == count \
+            and all(isinstance(entry, dict) and "storePath" in entry
+                    for entry in payload):
+        return [entry["storePath"] for entry in payload]
+    return None
+
+
+async def _upload_images(session: aiohttp.ClientSession,
+                         images: list) -> list:
+    """
+    Uploads one or more images, preferably in a single multipart request,
+    and returns their storePaths in order. Falls back to one request per
+    image (permanently, for this run) if the server rejects batches.
+
+    :param images: A list of ``(bytes, ext)`` tuples.
+    """
+    global _batch_upload
+    if len(images) > 1 and _batch_upload:
+        form = aiohttp.FormData()
+        for i, (image, ext) in enumerate(images):
+            form.add_field("file", image, filename=f"image{i}{ext}")
+        async with session.post(UPLOAD_URL, data=form) as resp:
+            payload = (await resp.json(content_type=None)).get("data")
+        paths = _parse_store_paths(payload, len(images))
+        if paths is not None:
+            return paths
+        _batch_upload = False
+    paths = []
+    for image, ext in images:
+        form = aiohttp.FormData()
+        form.add_field("file", image, filename=f"image{ext}")
+        async with session.post(UPLOAD_URL, data=form) as resp:
+            paths.append(
+                (await resp.json(content_type=None))["data"]["storePath"])
+    return paths
+
+
+async def _exe_clean(session: aiohttp.ClientSession, store_path: str) \
+        -> bytes:
+    """Runs the cleaning operations on one uploaded image."""
+    data = {
+        # Weird typo in the API.
+        "paramers": CLEAN_PARAMS,
+        "type": "image",
+        "storePath": store_path,
+        "userId": ""
+    }
+    async with session.post(EXE_URL, data=data) as resp:
+        result = (await resp.json(content_type=None))["data"]["outFileStr"]
+    return base64.b64decode(result)
+
+
+async def clean_pages_async(session: aiohttp.ClientSession,
+                            images: list) -> list:
+    """
+    Cleans a batch of images using docleaner's online service. Uncached
+    images are uploaded together in one multipart request to amortize the
+    per-request overhead; the cleaning call itself is per image and runs
+    concurrently. Results are memoized on disk by content hash, so
+    re-running on an unchanged page skips both round trips.
+
+    :param session: The shared aiohttp session (keep-alive).
+    :param images: A list of ``(bytes, ext)`` tuples.
+    :return: The cleaned images as raw bytes, in input order.
+    """
+    loop = asyncio.get_running_loop()
+    keys = [f"clean:{hashlib.sha256(image).hexdigest()}:{CLEAN_PARAMS}"
+            for image, _ in images]
+    results = [await loop.run_in_executor(None, _get_cache().get, key)
+               for key in keys]
+    misses = [i for i, cleaned in enumerate(results) if cleaned is None]
+    if misses:
+        paths = await _upload_images(session, [images[i] for i in misses])
+
+        async def clean_one(i: int, store_path: str):
+            cleaned = await _exe_clean(session, store_path)
+            await loop.run_in_executor(None, _get_cache().set, keys[i],
+                                       cleaned)
+            results[i] = cleaned
+
+        await asyncio.gather(*(clean_one(i, path)
+                               for i, path in zip(misses, paths)))
+    return results
+
+
+async def run_pipeline(page_args: Iterable[PageArgs],
+                       total: Optional[int],
+                       emit: Callable[[Tuple[int, Union[ImagePage, bytes]]],
+                                      None]):
+    """
+    Runs the three-stage pipeline: a rasterizer pool feeds image bytes into a
+    bounded queue, a set of async cleaner tasks sends them through docleaner,
+    and an OCR thread pool recognizes the cleaned pages in-process (tesserocr
+    releases the GIL, so the threads run in parallel). Each stage is sized to
+    its own resource (cores for rasterization and OCR, in-flight requests for
+    cleaning), so total runtime approaches that of the slowest stage rather
+    than their sum.
+
+    :param page_args: Per-page argument tuples (see :func:`_load_page`).
+    :param total: Number of pages to process, or None when the input is a
+        lazy iterator whose length is not yet known.
+    :param emit: Callback receiving ``(index, payload)`` tuples as pages
+        complete, in arbitrary order.
+    """
+    ncpu = os.cpu_count() or 1
+    raster_procs = max(1, ncpu // 4)
+    # Chunked, unordered dispatch: one pickle round trip per chunk rather
+    # than per page, and a fast worker is never blocked behind a slow page
+    # that happens to precede it. Page order is restored downstream anyway.
+    # Divide by ncpu rather than the (possibly single) rasterizer process
+    # count and cap the chunk, so one worker never monopolizes a quarter
+    # of the document.
+    chunksize = max(1, min(8, total // (4 * ncpu))) \
+        if total is not None else 4
+    loop = asyncio.get_running_loop()
+    # Depth 2x the consumer count, so a blocked consumer always has the next
+    # page ready the moment it frees up.
+    pending = asyncio.Queue(maxsize=2 * CLEAN_CONCURRENCY)
+    stopping = threading.Event()
+    feed_error = []
+
+    def put_from_feeder(item) -> bool:
+        """Cross-thread queue put; False once the loop is shutting down."""
+        try:
+            asyncio.run_coroutine_threadsafe(pending.put(item),
+                                             loop).result()
+            return True
+        except (CancelledError, asyncio.CancelledError, RuntimeError):
+            return False
+
+    with Pool(raster_procs) as raster_pool, \
+            ThreadPoolExecutor(max_workers=ncpu) as ocr_executor:
+        def feed():
+            try:
+                for result in raster_pool.imap_unordered(
+                        _load_page, page_args, chunksize=chunksize):
+                    idx, name, size, ext, ocr, clean = result
+                    shm = shared_memory.SharedMemory(name=name)
+                    image = bytes(shm.buf[:size])
+                    shm.close()
+                    shm.unlink()
+                    if not put_from_feeder((idx, image, ext, ocr, clean)):
+                        return
+            except BaseException as exc:  # noqa
+                # A genuine rasterizer failure; once the cleaner stage has
+                # already failed, anything raised here is teardown fallout
+                # of the terminating pool and only masks the root cause.
+                if not stopping.is_set():
+                    feed_error.append(exc)
+            finally:
+                # Unblocks the cleaner tasks, so a rasterizer failure
+                # crashes the run instead of hanging it.
+                for _ in range(CLEAN_CONCURRENCY):
+                    if not put_from_feeder(None):
+                        break
+
+        async def finish(idx: int, image: bytes, ocr: bool):
+            if image[:5] == b"%PDF-":
+                # A passed-through original page; already a single-page PDF.
+                payload = image
+            elif ocr:
+                payload = await loop.run_in_executor(ocr_executor, _ocr_page,
+                                                     image)
+            else:
+                # Image.open only parses the header here; the pixel data
+                # is never decoded.
+                with Image.open(io.BytesIO(image)) as probe:
+                    payload = (image, probe.width, probe.height)
+            emit((idx, payload))
+
+        async def worker(session: aiohttp.ClientSession):
+            while True:
+                item = await pending.get()
+                if item is None:
+                    return
+                # Opportunistically drain more pages into the same batch so
+                # their uploads share one request.
+                batch = [item]
+                size = len(item[1])
+                while len(batch) < UPLOAD_BATCH_PAGES \
+                        and size < UPLOAD_BATCH_BYTES:
+                    try:
+                        extra = pending.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                    if extra is None:
+                        # Not ours to consume: the sentinel has to reach
+                        # every worker.
+                        pending.put_nowait(extra)
+                        break
+                    batch.append(extra)
+                    size += len(extra[1])
+                to_clean = [(image, ext)
+                            for _, image, ext, _, clean in batch if clean]
+                cleaned = iter(await clean_pages_async(session, to_clean)
+                               if to_clean else ())
+                await asyncio.gather(
+                    *(finish(idx, next(cleaned) if clean else image, ocr)
+                      for idx, image, ext, ocr, clean in batch))
+
+        # A plain daemon thread rather than run_in_executor: the loop never
+        # waits on it during shutdown, so a feeder stuck in a terminating
+        # pool cannot deadlock an otherwise-failed run.
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        connector = aiohttp.TCPConnector(limit=CLEAN_CONCURRENCY)
+        # The interesting payload is base64-encoded JPEG, which barely
+        # compresses: asking for identity encoding skips a pointless
+        # decompression copy on every response.
+        headers = {"Connection": "keep-alive", "Accept-Encoding": "identity"}
+        try:
+            async with aiohttp.ClientSession(connector=connector,
+                                             headers=headers) as session:
+                await asyncio.gather(*(worker(session)
+                                       for _ in range(CLEAN_CONCURRENCY)))
+        except BaseException:
+            # Tell the feeder to stand down before the pool terminates;
+            # the cleaner failure below is the error worth reporting.
+            stopping.set()
+            raise
+        feeder.join()
+        if feed_error:
+            raise feed_error[0]
+
+
+def process_pages(page_args: Iterable[PageArgs], total: Optional[int],
+                  first_index: int) \
+        -> Iterator[Union[ImagePage, bytes]]:
+    """
+    Drives :func:`run_pipeline` on a background thread and yields the
+    processed pages in page order, reassembling out-of-order completions
+    through a min-heap. Merging can therefore start as soon as the first
+    page is done.
+
+    :param page_args: Per-page argument tuples (see :func:`_load_page`).
+    :param total: Number of pages to process, or None if not known up front.
+    :param first_index: Index of the first page.
+    """
+    completed = queue.Queue()
+
+    def run():
+        try:
+            asyncio.run(run_pipeline(page_args, total, completed.put))
+            completed.put(None)
+        except BaseException as exc:  # noqa
+            completed.put(exc)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    heap = []
+    next_idx = first_index
+    while True:
+        item = completed.get()
+        if item is None:
+            break
+        if isinstance(item, BaseException):
+            raise item
+        heapq.heappush(heap, item)
+        while heap and heap[0][0] == next_idx:
+            yield heapq.heappop(heap)[1]
+            next_idx += 1
+    thread.join()
+
+
+def iter_inputs(pattern: str) -> Iterator[str]:
+    """
+    Lazily yields the files matching a glob pattern (``**`` included) in
+    sorted order, walking directories with os.scandir and no per-file stat
+    calls. Unlike ``sorted(glob.glob(...))`` nothing is materialized up
+    front, so on large directories the pipeline starts on the first page
+    while the walk is still in progress. Order is sorted per directory,
+    depth-first.
+    """
+    def walk(prefix: str, parts) -> Iterator[str]:
+        head, rest = parts[0], parts[1:]
+        base = prefix or "."
+        if head in (os.curdir, os.pardir):
+            # A literal directory step; fnmatching it against scandir
+            # entries would match nothing.
+            if rest:
+                yield from walk(os.path.join(prefix, head), rest)
+            return
+        if head == "**":
+            if rest:
+                yield from walk(prefix, rest)
+            try:
+                with os.scandir(base) as entries:
+                    children = sorted(
+                        (entry.name, entry.is_dir(follow_symlinks=False))
+                        for entry in entries)
+            except OSError:
+                return
+            for name, is_dir in children:
+                if name.startswith("."):
+                    continue
+                if is_dir:
+                    yield from walk(os.path.join(prefix, name), parts)
+                elif not rest:
+                    # A trailing ** matches every file under the tree.
+                    yield os.path.join(prefix, name)
+            return
+        try:
+            with os.scandir(base) as entries:
+                matched = sorted(
+                    (entry.name, entry.is_dir()) for entry in entries
+                    if (not entry.name.startswith(".")
+                        or head.startswith("."))
+                    and fnmatch.fnmatch(entry.name, head))
+        except OSError:
+            return
+        for name, is_dir in matched:
+            path = os.path.join(prefix, name)
+            if rest:
+                if is_dir:
+                    yield from walk(path, rest)
+            elif not is_dir:
+                yield path
+
+    parts = [part for part in pattern.split(os.sep) if part]
+    prefix = os.sep if pattern.startswith(os.sep) else ""
+    if not parts:
+        return
+    yield from walk(prefix, parts)
 
 
 # noinspection PyShadowingBuiltins
@@ -125,48 +767,74 @@ def clean_single_page(args: Tuple[StrPath, int, int, bool, bool]) \
 @click.argument("input", type=click.Path())
 @click.argument("output", type=click.Path())
 @click.option("-d", "--dpi", default=300, help="DPI for rasterization.")
+@click.option("--auto-dpi", is_flag=True, default=False,
+              help="Probe the first page with OCR and lower the DPI when "
+                   "recognition confidence is already saturated. Overrides "
+                   "--dpi. PDF input only.")
 @click.option("--first-page", type=int, help="First page to convert/clean.")
 @click.option("--last-page", type=int, help="Last page to convert/clean.")
 @click.option("--ocr/--no-ocr", default=True,
               help="Whether to perform OCR during the conversion.")
 @click.option("--clean/--dont-clean", default=True,
               help="Whether to clean pdf using docleaner's online service.")
-def main(input: str, output: str, dpi: int,
+@click.option("--gray/--color", "gray", default=True,
+              help="Whether to rasterize in grayscale. Grayscale pages are "
+                   "a third the size and OCR quality is unaffected; use "
+                   "--color when figures matter.")
+def main(input: str, output: str, dpi: int, auto_dpi: bool,
          first_page: Optional[int], last_page: Optional[int], ocr: bool,
-         clean: bool):
+         clean: bool, gray: bool):
     if os.path.splitext(input)[1].lower() == ".pdf":
         # PDF mode
         assert os.path.exists(input)
-        page_count = fitz.Document(input).page_count
+        doc = fitz.Document(input)
         first_page = 0 if first_page is None else first_page - 1
-        last_page = page_count if last_page is None else last_page
-        args = zip(repeat(input), range(first_page, last_page),
-                   repeat(dpi), repeat(ocr), repeat(clean))
+        last_page = doc.page_count if last_page is None else last_page
+        if auto_dpi:
+            dpi = choose_dpi(input, first_page, gray)
+            click.echo(f"auto-dpi: rasterizing at {dpi} DPI")
+        # Born-digital pages keep their text layer and are copied verbatim;
+        # rasterizing + OCR-ing them could only lose fidelity. Only possible
+        # when the output is itself a PDF.
+        text_pages = set()
+        if os.path.splitext(output)[1].lower() == ".pdf":
+            text_pages = {i for i in range(first_page, last_page)
+                          if len(doc[i].get_text()) > TEXT_PAGE_THRESHOLD}
+        doc.close()
+        args = ((input, i, dpi, ocr, clean, gray, i in text_pages,
+                 i + 1 < last_page and i + 1 not in text_pages)
+                for i in range(first_page, last_page))
+        total = last_page - first_page
     else:
-        # Glob mode
-        files = sorted(glob.glob(input, recursive=True))
+        # Glob mode. The matches are consumed lazily, so processing starts
+        # on the first file while the directory walk continues.
         first_page = 0 if first_page is None else first_page - 1
-        last_page = len(files) if last_page is None else last_page
-        args = zip(files[first_page:last_page], repeat(0), repeat(-1),
-                   repeat(ocr), repeat(clean))
-    total = last_page - first_page
-    with Pool() as p:
-        results = tqdm(p.imap(clean_single_page, args), total=total)
-        if os.path.splitext(output)[1].lower() == ".pdf":
-            merge_to_pdf(results, output)
-        elif not os.path.exists(output) or os.path.isdir(output):
-            if ocr:
-                raise RuntimeError("the OCR flag is useless because we are "
-                                   "writing images (not PDF) to the output "
-                                   "directory.")
-            if not os.path.exists(output):
-                Path(output).mkdir(parents=True)
-            for (index, page) in enumerate(results):
-                file_path = os.path.join(output, f"{index}.jpg")
-                assert isinstance(page, Image.Image)
-                page.save(file_path)
-        else:
-            raise RuntimeError("invalid output format.")
+        files = islice(iter_inputs(input), first_page, last_page)
+        args = ((file, idx, -1, ocr, clean, gray, False, False)
+                for idx, file in enumerate(files, start=first_page))
+        total = None if last_page is None else last_page - first_page
+    results = tqdm(process_pages(args, total, first_page), total=total)
+    if os.path.splitext(output)[1].lower() == ".pdf":
+        merge_to_pdf(results, output)
+    elif not os.path.exists(output) or os.path.isdir(output):
+        if ocr:
+            raise RuntimeError("the OCR flag is useless because we are "
+                               "writing images (not PDF) to the output "
+                               "directory.")
+        if not os.path.exists(output):
+            Path(output).mkdir(parents=True)
+        for (index, page) in enumerate(results):
+            file_path = os.path.join(output, f"{index}.jpg")
+            assert isinstance(page, tuple)
+            data = page[0]
+            if data[:2] == b"\xff\xd8":  # Already a JPEG, dump as-is.
+                with open(file_path, "wb") as file:
+                    file.write(data)
+            else:
+                with Image.open(io.BytesIO(data)) as page_image:
+                    page_image.save(file_path)
+    else:
+        raise RuntimeError("invalid output format.")
 
 
 if __name__ == "__main__":